@@ -3,18 +3,22 @@
 Implementation of the subscriber functionality.
 """
 
+import os
 import sys
 import socket
-import threading
-from datetime import datetime, timedelta
+import time
+from datetime import timedelta
 import unmarshalling as fbs
 import bellman_ford
 import math
+import heapq
 
 SUBSCRIBER_ADDRESS = ('localhost', 12534)  # Address where subscriber listens
 BUF_SZ = 4096
+SO_RCVBUF_BYTES = int(os.environ.get('SO_RCVBUF_BYTES', 4 * 1024 * 1024))  # kernel buffer to absorb bursts
 TIMEOUT_SECONDS = 10
 QUOTE_EXPIRATION = 1.5 
+QUOTE_EXPIRATION_MICROS = int(QUOTE_EXPIRATION * fbs.MICROS_PER_SECOND)
 
 
 class Subscriber(object):
@@ -27,14 +31,21 @@ class Subscriber(object):
         """
         self.subscriber_address = subscriber_address
         self.request_address = request_address
+        self.subscription_request = fbs.serialize_address(*subscriber_address)
         self.graph = bellman_ford.BellmanFord()
-        self.latest_timestamps = {}
+        self.latest_timestamps = {}  # keyed by (currency1, currency2) market
+        self.expiry_heap = []  # (expiry time, market), may hold superseded entries
+        self.rates = {}  # exchange rate keyed by (from_currency, to_currency)
+        self.graph_changed = False  # set when edges change, cleared by check_for_arbitrage
+        self.recv_buffer = bytearray(BUF_SZ)  # reused for every datagram
+        self.recv_view = memoryview(self.recv_buffer)
     
     def run(self):
-        """Starts the listening thread and sends subscription request."""
-        listener_thread = threading.Thread(target=self.start_listening, args=(self.subscriber_address,))
-        listener_thread.start()
-        self.subscribe_to_forex(self.subscriber_address, self.request_address)
+        """Binds the listening socket, sends subscription request and then listens for quotes."""
+        # Bind before subscribing, the provider publishes as soon as it registers us
+        with self.start_a_listener(self.subscriber_address) as sock:
+            self.subscribe_to_forex(self.subscriber_address, self.request_address)
+            self.start_listening(sock)
     
     def subscribe_to_forex(self, subscriber_address, request_address):
         """
@@ -43,28 +54,37 @@ class Subscriber(object):
         :param subscriber_address: the address of the subscriber
         :param request_address: the address of the Forex Provider
         """
-        serialized_subscriber_address = fbs.serialize_address(subscriber_address[0], subscriber_address[1])
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.sendto(serialized_subscriber_address, request_address)
+            sock.sendto(self.subscription_request, request_address)
             print(f"Subscription request sent from {subscriber_address} to {request_address}")
 
-    def start_listening(self, subscriber_address):
+    @staticmethod
+    def start_a_listener(subscriber_address):
         """
-        Listens for incoming messages from the Forex Provider and processes them.
+        Start a socket bound to the address where the subscriber listens for messages.
 
         :param subscriber_address: the address on which the subscriber listens for messages
+        :return: bound socket
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.bind(subscriber_address)
-            sock.settimeout(TIMEOUT_SECONDS)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(subscriber_address)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SO_RCVBUF_BYTES)
+        sock.settimeout(TIMEOUT_SECONDS)
+        return sock
 
-            while True:
-                try:
-                    data = sock.recv(BUF_SZ)
-                    self.process_received_data(data)
-                except socket.timeout:
-                    print(f"No messages received in {TIMEOUT_SECONDS} seconds. Subscription was cancelled. Closing listener thread.")
-                    break
+    def start_listening(self, sock):
+        """
+        Listens for incoming messages from the Forex Provider and processes them.
+
+        :param sock: the bound socket on which the subscriber listens for messages
+        """
+        while True:
+            try:
+                n = sock.recv_into(self.recv_buffer)
+                self.process_received_data(self.recv_view[:n])
+            except socket.timeout:
+                print(f"No messages received in {TIMEOUT_SECONDS} seconds. Subscription was cancelled. Closing listener.")
+                break
 
     def process_received_data(self, data):
         """
@@ -74,31 +94,34 @@ class Subscriber(object):
         :param data: the data received from the Forex Provider
         """
         quotes = fbs.unmarshal_message(data)  # unmarshal the received message
-        now = datetime.utcnow()  # get the current time
+        now = time.time_ns() // 1000  # get the current time in microseconds since the epoch
 
         # Remove expired quotes from the graph
         self.remove_expired_quotes(now)
 
-        for quote in quotes:
-            cross = quote['cross']  # the currency pair
-            currency1 = cross[:3]
-            currency2 = cross[4:]
-            price = quote['price']  # the price for the currency pair
-            timestamp = quote['time']  # the timestamp of the quote
+        # Keep only the newest in-sequence price for each market in this message
+        latest = {}
+        latest_timestamps = self.latest_timestamps
+        # timestamp is in microseconds since the epoch
+        for currency1, currency2, price, timestamp in quotes:
+            market = (currency1, currency2)
 
-            # Check if the quote is outdated
-            if cross in self.latest_timestamps and timestamp <= self.latest_timestamps[cross]:
-                print(f"{timestamp} {currency1} {currency2} {price}")
+            # Check if the quote is outdated, also against earlier quotes in this message
+            if timestamp <= latest_timestamps.get(market, 0):
+                print(f"{self.format_timestamp(timestamp)} {currency1} {currency2} {price}")
                 print("ignoring out-of-sequence message")
                 continue
 
-            print(f"{timestamp} {currency1} {currency2} {price}")
+            print(f"{self.format_timestamp(timestamp)} {currency1} {currency2} {price}")
 
             # Update the timestamp
-            self.latest_timestamps[cross] = timestamp
+            latest_timestamps[market] = timestamp
+            latest[market] = price
 
-            # Update the graph with the latest rates
-            self.update_graph(currency1, currency2, price)
+        # Update the graph with the latest rates
+        for market, price in latest.items():
+            heapq.heappush(self.expiry_heap, (latest_timestamps[market] + QUOTE_EXPIRATION_MICROS, market))
+            self.update_graph(market[0], market[1], price)
 
         # Check for arbitrage opportunities after updating the graph
         self.check_for_arbitrage()
@@ -111,40 +134,71 @@ class Subscriber(object):
         :param currency2: the second currency in the pair
         :param price: the price for the currency pair
         """
-        if price > 0:
-            # Add edge for currency1 -> currency2 with weight -log(rate)
-            self.graph.add_edge(currency1, currency2, -math.log10(price))
-            # Add edge for currency2 -> currency1 with weight log(rate)
-            self.graph.add_edge(currency2, currency1, math.log10(price))
+        if price <= 0:
+            return
+
+        weight = -math.log10(price)
+        if self.graph.edges.get(currency1, {}).get(currency2) == weight:
+            return  # repeated price, edges already hold this weight
+
+        # Add edge for currency1 -> currency2 with weight -log(rate)
+        self.graph.add_edge(currency1, currency2, weight)
+        # Add edge for currency2 -> currency1 with weight log(rate)
+        self.graph.add_edge(currency2, currency1, -weight)
+        self.rates[(currency1, currency2)] = price
+        self.rates[(currency2, currency1)] = 1 / price
+        self.graph_changed = True
 
     def remove_expired_quotes(self, current_time):
         """
         Removes expired quotes from the graph if they are older than 1.5 seconds.
 
-        :param current_time: the current time used to compare timestamps
+        :param current_time: the current time in microseconds since the epoch
         """
-        expired_markets = [market for market, ts in self.latest_timestamps.items()
-                           if (current_time - ts).total_seconds() > QUOTE_EXPIRATION]
-        for market in expired_markets:
-            currency1 = market[:3]
-            currency2 = market[4:]
+        heap = self.expiry_heap
+        while heap and heap[0][0] < current_time:
+            _, market = heapq.heappop(heap)
+            # Skip entries superseded by a newer quote or for markets already removed
+            ts = self.latest_timestamps.get(market)
+            if ts is None or current_time - ts <= QUOTE_EXPIRATION_MICROS:
+                continue
+            currency1, currency2 = market
 
             # Remove edges for the expired currency pair from the graph
             try:
                 self.graph.remove_edge(currency1, currency2)
                 self.graph.remove_edge(currency2, currency1)
+                self.graph_changed = True
                 print(f"removing stale quote for ('{currency1}', '{currency2}')")
             except KeyError:
                 pass  # ignore if the edge doesn't exist
 
+            self.rates.pop(market, None)
+            self.rates.pop((currency2, currency1), None)
             del self.latest_timestamps[market]
 
+    @staticmethod
+    def format_timestamp(timestamp):
+        """
+        Converts a timestamp into a UTC datetime for display.
+
+        :param timestamp: microseconds since the epoch
+        :return: naive datetime in UTC
+        """
+        return fbs.EPOCH + timedelta(microseconds=timestamp)
+
     def check_for_arbitrage(self):
         """
         Checks for arbitrage opportunities by running the Bellman-Ford algorithm.
         Only cycles that start and end with USD are considered.
+        Nothing is done if the graph has not changed since the last check.
         """
-        if 'USD' not in self.graph.vertices:
+        if not self.graph_changed:
+            return
+        self.graph_changed = False
+
+        # A cycle through USD needs at least two USD markets, hence three currencies
+        if len(self.graph.vertices) < 3 or len(self.graph.edges.get('USD', {})) < 2:
             return
 
         start_currency = 'USD'
@@ -176,10 +230,11 @@ class Subscriber(object):
         print("ARBITRAGE:")
         print(f"\tstart with {initial_currency} {amount}")
 
+        rates = self.rates
         for i in range(len(cycle) - 1):
             from_currency = cycle[i]
             to_currency = cycle[i + 1]
-            rate = 10 ** (-self.graph.edges[from_currency][to_currency])  # Convert back to rate
+            rate = rates[(from_currency, to_currency)]
             amount *= rate
             print(f"\texchange {from_currency} for {to_currency} at {rate} --> {to_currency} {amount}")
 
@@ -2,24 +2,36 @@
 :Authors: Lisa Lomidze, Kevin Lundeen
 This module contains useful unmarshalling functions for manipulating subscription on the Forex Provider.
 """
-import ipaddress
-from array import array
+import socket
+import struct
+import sys
 from datetime import datetime, timedelta
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
+EPOCH = datetime(1970, 1, 1)
 
+# A quote record is 32 bytes: 3+3 ASCII currencies, little-endian float price,
+# big-endian 64-bit timestamp and 14 bytes of padding. Since the price and the
+# timestamp use different byte orders, the record is read through two views.
+CROSS_PRICE_RECORD = struct.Struct('<3s3sf22x')
+TIME_RECORD = struct.Struct('>10xQ14x')
+ADDRESS = struct.Struct('!4sH')
+PRICE = struct.Struct('<f')
+TIMESTAMP = struct.Struct('>Q')
 
-def deserialize_price(b: bytes) -> float:
+CURRENCIES = {}  # interned currency name keyed by its 3 raw bytes, letters only
+
+
+def deserialize_price(b: bytes, offset: int = 0) -> float:
     """
     Convert a byte array back to a float, which represents a price in the Forex price feed.
 
-    :param b: 4-byte sequence representing a float
+    :param b: buffer holding a 4-byte little-endian float
+    :param offset: position of the price within b
     :return: floating-point number representing the price
     """
-    a = array('f')
-    a.frombytes(b)
-    return a[0]
+    return PRICE.unpack_from(b, offset)[0]
 
 
 def serialize_address(host: str, port: int) -> bytes:
@@ -32,45 +44,77 @@ def serialize_address(host: str, port: int) -> bytes:
     """
     if host == 'localhost':
         host = '127.0.0.1'
-    ip = ipaddress.ip_address(host).packed
-    p = array('H', [port])
-    p.byteswap()
-    return ip + p.tobytes()
+    return ADDRESS.pack(socket.inet_aton(host), port)
 
-def deserialize_utcdatetime(b: bytes) -> datetime:
+def deserialize_currency(b: bytes) -> str:
     """
-    Convert a byte stream (8 bytes) into a UTC datetime. The byte stream represents
-    the number of microseconds since 00:00:00 UTC on January 1, 1970.
+    Convert a 3-byte currency code into a string. Well-formed codes (ASCII letters) are
+    interned and remembered, so later quotes for the same currency skip the decoding
+    altogether. Anything else is decoded as is and not remembered, so junk arriving on
+    the port cannot grow the cache.
+
+    >>> deserialize_currency(b'GBP'), b'GBP' in CURRENCIES
+    ('GBP', True)
+    >>> deserialize_currency(b'US1'), b'US1' in CURRENCIES
+    ('US1', False)
 
-    :param b: 8-byte stream representing the timestamp
-    :return: datetime object in UTC
+    :param b: 3-byte ASCII currency code
+    :return: currency name
     """
-    a = array('Q')
-    a.frombytes(b)
-    a.byteswap()
-    micros_since_epoch = a[0]
-    epoch = datetime(1970, 1, 1)
-    return epoch + timedelta(microseconds=micros_since_epoch)
+    if not (b.isascii() and b.isalpha()):
+        return b.decode('latin-1')
+    currency = CURRENCIES[b] = sys.intern(b.decode('ascii'))
+    return currency
 
 
-def unmarshal_message(b: bytes):
+def deserialize_utcdatetime_us(b: bytes, offset: int = 0) -> int:
     """
-    Convert a byte stream into a list of quote dictionaries. Each dictionary contains
-    'cross' (currency pair), 'price', and optionally 'time'.
+    Convert a byte stream (8 bytes) into a UTC timestamp. The byte stream represents
+    the number of microseconds since 00:00:00 UTC on January 1, 1970, and is returned
+    as is so that callers can compare timestamps with integer arithmetic.
 
-    :param b: byte stream representing multiple quotes
-    :return: list of dictionaries with 'cross', 'price', and optionally 'time'
+    :param b: buffer holding the 8-byte big-endian timestamp
+    :param offset: position of the timestamp within b
+    :return: microseconds since the epoch
     """
-    quotes = []
-    default_time = datetime.utcnow()
+    return TIMESTAMP.unpack_from(b, offset)[0]
 
-    for i in range(0, len(b), 32):
-        record = b[i:i + 32]
-        cross = record[0:3].decode('ascii') + '/' + record[3:6].decode('ascii')
-        price = deserialize_price(record[6:10])
-        timestamp = deserialize_utcdatetime(record[10:18])
 
-        quote = {'cross': cross, 'price': price, 'time': timestamp}
-        quotes.append(quote)
+def deserialize_utcdatetime_obj(b: bytes, offset: int = 0) -> datetime:
+    """
+    Convert a byte stream (8 bytes) into a UTC datetime. Prefer deserialize_utcdatetime_us
+    unless a datetime is actually needed, e.g. for display.
+
+    :param b: buffer holding the 8-byte big-endian timestamp
+    :param offset: position of the timestamp within b
+    :return: naive datetime in UTC
+    """
+    return EPOCH + timedelta(microseconds=deserialize_utcdatetime_us(b, offset))
 
-    return quotes
+
+def unmarshal_message(b):
+    """
+    Convert a byte stream into a list of quotes. Each quote is a (currency1, currency2,
+    price, time) tuple of the currency pair, the price and microseconds since the epoch.
+    Currency names are interned, so lookups keyed by them compare by identity.
+    Any trailing bytes short of a whole 32-byte record are ignored.
+
+    >>> from marshalling import marshal_message
+    >>> q1 = {'cross': 'GBP/USD', 'price': 1.25, 'time': datetime(2006, 1, 2)}
+    >>> q2 = {'cross': 'USD/JPY', 'price': 108.5, 'time': datetime(2006, 1, 1)}
+    >>> b = marshal_message([q1, q2])
+    >>> unmarshal_message(b)
+    [('GBP', 'USD', 1.25, 1136160000000000), ('USD', 'JPY', 108.5, 1136073600000000)]
+    >>> unmarshal_message(memoryview(b + b'\\x00' * 20)) == unmarshal_message(b)
+    True
+
+    :param b: byte stream (any bytes-like object, e.g. a memoryview) representing multiple quotes
+    :return: list of (currency1, currency2, price, time) tuples
+    """
+    b = b[:len(b) - len(b) % CROSS_PRICE_RECORD.size]  # drop a truncated last record
+    records = zip(CROSS_PRICE_RECORD.iter_unpack(b), TIME_RECORD.iter_unpack(b))
+    currency = CURRENCIES.get
+    return [(currency(currency1) or deserialize_currency(currency1),
+             currency(currency2) or deserialize_currency(currency2),
+             price, micros)
+            for (currency1, currency2, price), (micros,) in records]